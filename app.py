@@ -1,18 +1,24 @@
 import os
 import re
-import json
 import logging
 import asyncio
+import contextlib
 import random
-import base64
+import hashlib
 import time
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List, Tuple
+from bisect import bisect_right
+from itertools import chain, repeat
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, List, Tuple, Union
 from io import BytesIO
+from types import MappingProxyType
 
 import aiohttp
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+import orjson
+import pybase64
+from cachetools import TTLCache
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
 from PIL import Image, ImageEnhance, ImageFilter
 
 from telegram import Update as TgUpdate, Bot, Update
@@ -26,17 +32,68 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
+# 🏓 САМОПИНГ (нужен только на free tier Render, включается переменной окружения)
+ENABLE_KEEPALIVE = os.getenv("ENABLE_KEEPALIVE", "").lower() in ("1", "true", "yes")
+KEEPALIVE_URL = "https://surfhunter-bot.onrender.com/ping"
+KEEPALIVE_INTERVAL = 840        # 14 минут: Render free tier засыпает после 15
+KEEPALIVE_RETRY_DELAY = 60      # после сбоя переспрашиваем раньше: 1, 2, 4, 8 минут, дальше не реже INTERVAL
+
+# 🖼️ ГРАНИЦЫ РАЗМЕРА СКРИНШОТА ДЛЯ VISION-МОДЕЛЕЙ
+MIN_IMAGE_BYTES = 5_000         # миниатюры и битые загрузки
+MAX_IMAGE_BYTES = 10_000_000    # такое API всё равно отклонят
+VISION_MAX_SIDE = 1280          # длинная сторона картинки, уходящей в vision-модели
+VISION_JPEG_QUALITY = 80
+
 if not TELEGRAM_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN not found")
 
-app = FastAPI(title="Poseidon V7")
+app = FastAPI(title="Poseidon V7", default_response_class=ORJSONResponse)
 bot = Bot(token=TELEGRAM_TOKEN)
-bot_app = Application.builder().token(TELEGRAM_TOKEN).build()
+# Апдейты разных чатов обрабатываются параллельно; очерёдность внутри чата держит ChatState.lock
+bot_app = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(True).build()
+
+@dataclass(slots=True)
+class ChatState:
+    """Состояние диалога в одном чате"""
+    active: bool = False
+    awaiting_feedback: bool = False
+    # Скриншоты одного чата разбираются по очереди
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+# chat_id -> ChatState; чаты, молчащие дольше TTL, забываются сами
+USER_STATE_MAXSIZE = 10_000
+USER_STATE_TTL = 1800
+USER_STATE: TTLCache = TTLCache(maxsize=USER_STATE_MAXSIZE, ttl=USER_STATE_TTL)
+
+def touch_state(chat_id: int) -> Optional[ChatState]:
+    """Состояние чата с продлением TTL: TTLCache отсчитывает срок от записи, а не от чтения"""
+    state = USER_STATE.get(chat_id)
+    if state is not None:
+        USER_STATE[chat_id] = state
+    return state
+
+# 🧠 КЭШ РАЗБОРОВ: повторно присланный скриншот не гоняем через AI.
+# В результате есть живой прогноз Windy, поэтому он устаревает через 15 минут
+ANALYSIS_CACHE_SIZE = 256
+ANALYSIS_CACHE_TTL = 900
+_ANALYSIS_CACHE: TTLCache = TTLCache(maxsize=ANALYSIS_CACHE_SIZE, ttl=ANALYSIS_CACHE_TTL)
+
+# (модель, хэш скриншота) -> разбор; от спота и даты он не зависит, TTL только ограничивает память
+VISION_CACHE_MAXSIZE = 512
+VISION_CACHE_TTL = 3600
+_VISION_CACHE: TTLCache = TTLCache(maxsize=VISION_CACHE_MAXSIZE, ttl=VISION_CACHE_TTL)
 
-USER_STATE: Dict[int, Dict[str, Any]] = {}
+# 🏁 ГОНКА ИСТОЧНИКОВ: хватает одного хорошего ответа vision-модели, отстающих ждём недолго.
+# Windy гонку не завершает: без приливов и мощности он набирает до 80 баллов, но отчёт беднее
+RACE_GOOD_SCORE = 70
+RACE_GRACE_SECONDS = 2.0
+
+# 🔑 КЛЮЧЕВЫЕ ФРАЗЫ ЧАТА (ищутся одним проходом по тексту)
+TRIGGER_PHRASE = "посейдон на связь"
+_KEYWORDS_RE = re.compile(r"посейдон на связь|отлично|не очень")
 
 # 🗺️ СЛОВАРЬ СПОТОВ БАЛИ (координаты для Windy API)
-BALI_SPOTS = {
+BALI_SPOTS = MappingProxyType({
     "uluwatu": {"lat": -8.8282, "lng": 115.0861, "name": "Uluwatu"},
     "balangan": {"lat": -8.7909, "lng": 115.1264, "name": "Balangan Beach"},
     "kuta": {"lat": -8.7222, "lng": 115.1721, "name": "Kuta Beach"},
@@ -55,7 +112,21 @@ BALI_SPOTS = {
     "nusadua": {"lat": -8.7947, "lng": 115.2350, "name": "Nusa Dua"},
     "nikobali": {"lat": -8.6800, "lng": 115.2600, "name": "Niko Bali"}, 
     "balikutareef": {"lat": -8.7200, "lng": 115.1700, "name": "Bali Kuta Reef"}
-}
+})
+
+def get_spot(name: str) -> Optional[Dict[str, Any]]:
+    """Спот по имени; подпись уже приходит в нижнем регистре, lower() нужен только на промахе"""
+    return BALI_SPOTS.get(name) or BALI_SPOTS.get(name.lower())
+
+# 🔱 ПРИВЕТСТВИЕ (список спотов не меняется, собираем один раз)
+SPOT_LIST_TEXT = "\n".join(f"• {spot['name']}" for spot in BALI_SPOTS.values())
+GREETING_TEXT = (
+    f"🔱 Посейдон тут, смертный!\n\n"
+    f"Давай свой скриншот прогноза с подписью в формате:\n"
+    f"`balangan 2024-11-06`\n\n"
+    f"Доступные споты:\n{SPOT_LIST_TEXT}\n\n"
+    f"Я проверю данные через 3 источника: OpenAI + DeepSeek + Windy API!"
+)
 
 # 🔥 АНГЛИЙСКИЙ ПРОМТ ДЛЯ ПАРСИНГА (используется и в OpenAI и в DeepSeek)
 ENGLISH_PARSING_PROMPT = """EXTRACT SURF DATA FROM WINDY SCREENSHOT AND RETURN ONLY JSON:
@@ -85,32 +156,85 @@ RETURN ONLY THIS JSON FORMAT:
 
 ONLY JSON, NO OTHER TEXT!"""
 
-async def keep_alive_ping():
-    """Тихий пинг с минимальным логированием"""
+# 🐋 ПОСТОЯННЫЕ ЧАСТИ ЗАПРОСА К DEEPSEEK (собираются один раз при импорте)
+_DEEPSEEK_HEADERS = {
+    "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+    "Content-Type": "application/json"
+} if DEEPSEEK_API_KEY else {}
+
+_DEEPSEEK_PAYLOAD_TEMPLATE = {
+    "model": "deepseek-chat",
+    "temperature": 0.1,
+    "max_tokens": 1500,
+    "response_format": {"type": "json_object"}
+}
+
+# 🤖 ПОСТОЯННЫЕ ЧАСТИ ЗАПРОСА К OPENAI
+_OPENAI_HEADERS = {
+    "Authorization": f"Bearer {OPENAI_API_KEY}",
+    "Content-Type": "application/json"
+} if OPENAI_API_KEY else {}
+
+_OPENAI_PAYLOAD_TEMPLATE = {
+    "model": "gpt-4-vision-preview",
+    "max_tokens": 1500,
+    "temperature": 0.1
+}
+
+# Одна попытка к vision-модели: быстро отваливаемся на коннекте, на ответ даём 20с
+_VISION_TIMEOUT = aiohttp.ClientTimeout(total=25, connect=5, sock_connect=5, sock_read=20)
+
+# 🔁 ПОВТОРЫ: перегрузку и обрыв соединения переспрашиваем с паузами 0.5с и 2с.
+# Зависший ответ не повторяем, а все попытки вместе укладываются в VISION_DEADLINE
+VISION_RETRY_DELAYS = (0.5, 2.0)
+VISION_DEADLINE = 30
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+_RETRY_ERRORS = (aiohttp.ClientConnectorError, aiohttp.ServerDisconnectedError)
+
+# Не больше 4 запросов к DeepSeek одновременно: меньше 429 и base64-строк в памяти
+_DEEPSEEK_SEM = asyncio.Semaphore(4)
+
+# OpenAI запросы ничем не ограничиваем
+_NO_LIMIT = contextlib.nullcontext()
+
+async def keep_alive_ping(session: aiohttp.ClientSession):
+    """Тихий пинг с минимальным логированием; после ошибки повторяем раньше, а не позже"""
+    errors = 0
+    timeout = aiohttp.ClientTimeout(total=10)
     while True:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    "https://surfhunter-bot.onrender.com/ping",
-                    timeout=10
-                ) as response:
-                    if response.status != 200:
-                        # Логируем только если несколько раз подряд ошибка
-                        pass
+            async with session.head(KEEPALIVE_URL, timeout=timeout) as response:
+                errors = 0 if response.status == 200 else errors + 1
         except Exception:
-            # Игнорируем ошибки - это нормально для free tier
-            pass
+            # Ошибки - это нормально для free tier, просто повторяем
+            errors += 1
         
-        await asyncio.sleep(300)  # 5 минут
+        # Любая пауза короче 15 минут простоя, иначе Render усыпит сервис вместе с пингом
+        if errors:
+            delay = min(KEEPALIVE_RETRY_DELAY * 2 ** min(errors - 1, 4), KEEPALIVE_INTERVAL)
+        else:
+            delay = KEEPALIVE_INTERVAL
+        await asyncio.sleep(delay)
 
-def enhance_image_for_ocr(image_bytes: bytes) -> bytes:
+def enhance_image_for_ocr(image_bytes: Union[bytes, bytearray, memoryview]) -> Union[bytes, bytearray, memoryview]:
     """Улучшает качество изображения для OCR"""
     try:
         image = Image.open(BytesIO(image_bytes))
+        if image.format == 'JPEG':
+            # libjpeg сразу декодирует в уменьшенном масштабе (не меньше целевого)
+            image.draft('L', (VISION_MAX_SIDE, VISION_MAX_SIDE))
+        
+        # Модели нужны только цифры таблицы: в оттенках серого все фильтры
+        # ниже обрабатывают один канал вместо трёх
+        image = image.convert('L')
         
-        if image.size[0] < 800:
+        if image.size[0] < 500:
+            # Совсем мелкий скриншот: для цифр хватает билинейки (4 отсчёта против 36 у Lanczos)
             new_size = (image.size[0] * 2, image.size[1] * 2)
-            image = image.resize(new_size, Image.Resampling.LANCZOS)
+            image = image.resize(new_size, Image.Resampling.BILINEAR)
+        else:
+            # Цифры Windy читаются и так, а фильтры, base64 и токены модели платят за каждый пиксель
+            image.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE), Image.Resampling.LANCZOS)
         
         enhancer = ImageEnhance.Contrast(image)
         image = enhancer.enhance(2.0)
@@ -121,28 +245,31 @@ def enhance_image_for_ocr(image_bytes: bytes) -> bytes:
         image = image.filter(ImageFilter.SMOOTH)
         
         output_buffer = BytesIO()
-        image.save(output_buffer, format='JPEG', quality=95)
+        image.save(output_buffer, format='JPEG', quality=VISION_JPEG_QUALITY, optimize=True)
         
         logger.info("✅ Image enhanced for OCR")
-        return output_buffer.getvalue()
+        # Отдаём буфер без копии: pybase64 читает memoryview напрямую
+        return output_buffer.getbuffer()
         
     except Exception as e:
         logger.error(f"❌ Image enhancement failed: {e}")
         return image_bytes
 
+_DATA_URL_PREFIX = "data:image/jpeg;base64,"
+
+def prepare_image_payload(image_bytes: Union[bytes, bytearray, memoryview]) -> str:
+    """Улучшенный скриншот в виде data URL для vision-моделей (весь CPU-этап целиком)"""
+    enhanced_image_bytes = enhance_image_for_ocr(image_bytes)
+    return _DATA_URL_PREFIX + pybase64.b64encode_as_string(enhanced_image_bytes)
+
 async def fetch_windy_api_data(spot_name: str, date: str) -> Dict[str, Any]:
     """Получение данных напрямую с Windy API"""
     try:
-        spot = BALI_SPOTS.get(spot_name.lower())
+        spot = get_spot(spot_name)
         if not spot:
             logger.warning(f"❌ Spot {spot_name} not found in database")
             return None
         
-        # Конвертируем дату в timestamp
-        target_date = datetime.strptime(date, "%Y-%m-%d")
-        start_ts = int(target_date.timestamp())
-        end_ts = int((target_date + timedelta(days=1)).timestamp())
-        
         # Параметры для Windy API
         params = {
             'lat': spot['lat'],
@@ -153,173 +280,188 @@ async def fetch_windy_api_data(spot_name: str, date: str) -> Dict[str, Any]:
             'key': 'your_windy_api_key_here'
         }
         
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                'https://api.windy.com/api/point-forecast/v2',
-                params=params,
-                timeout=20
-            ) as response:
+        session = app.state.http
+        async with session.get(
+            'https://api.windy.com/api/point-forecast/v2',
+            params=params,
+            timeout=20
+        ) as response:
+            
+            if response.status == 200:
+                data = orjson.loads(await response.read())
                 
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    # Парсим данные волн и ветра
-                    wave_heights = []
-                    wave_periods = [] 
-                    wind_speeds = []
-                    
-                    if 'waves' in data:
-                        for hour_data in data['waves'][:10]:
-                            wave_heights.append(round(hour_data.get('waveHeight', 0), 1))
-                            wave_periods.append(round(hour_data.get('wavePeriod', 0), 1))
-                    
-                    if 'wind' in data:
-                        for hour_data in data['wind'][:10]:
-                            wind_speeds.append(round(hour_data.get('speed', 0), 1))
-                    
-                    logger.info(f"✅ Windy API data fetched for {spot_name}")
-                    return {
-                        "wave_data": wave_heights,
-                        "period_data": wave_periods,
-                        "wind_data": wind_speeds,
-                        "power_data": [],
-                        "tides": {},
-                        "source": "windy_api"
-                    }
-                else:
-                    logger.warning(f"⚠️ Windy API error: {response.status}")
-                    return None
+                # Парсим данные волн и ветра
+                wave_heights = []
+                wave_periods = [] 
+                wind_speeds = []
+                
+                if 'waves' in data:
+                    for hour_data in data['waves'][:10]:
+                        wave_heights.append(round(hour_data.get('waveHeight', 0), 1))
+                        wave_periods.append(round(hour_data.get('wavePeriod', 0), 1))
+                
+                if 'wind' in data:
+                    for hour_data in data['wind'][:10]:
+                        wind_speeds.append(round(hour_data.get('speed', 0), 1))
+                
+                logger.info(f"✅ Windy API data fetched for {spot_name}")
+                return {
+                    "wave_data": wave_heights,
+                    "period_data": wave_periods,
+                    "wind_data": wind_speeds,
+                    "power_data": [],
+                    "tides": {},
+                    "source": "windy_api"
+                }
+            else:
+                logger.warning(f"⚠️ Windy API error: {response.status}")
+                return None
                     
     except Exception as e:
         logger.error(f"❌ Windy API fetch error: {e}")
         return None
 
-async def parse_with_openai(image_bytes: bytes) -> Dict[str, Any]:
-    """Парсинг скриншота через OpenAI с английским промтом"""
-    if not OPENAI_API_KEY:
+# Структурные символы JSON: между ними сканер ничего не разбирает
+_JSON_TOKEN_RE = re.compile(r'[{}"\\]')
+
+def find_json_object(text: str) -> Optional[str]:
+    """Первый сбалансированный {...} в тексте, за один линейный проход без бэктрекинга"""
+    start = text.find('{')
+    if start < 0:
         return None
-        
+    
+    depth = 0
+    in_string = False
+    skip_until = -1
+    for match in _JSON_TOKEN_RE.finditer(text, start):
+        i = match.start()
+        if i < skip_until:
+            continue
+        char = match.group()
+        if in_string:
+            if char == '\\':
+                skip_until = i + 2
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+def extract_json_from_content(content: str) -> Optional[Dict[str, Any]]:
+    """Достаёт JSON из ответа модели: сначала весь ответ, потом поиск объекта в тексте"""
     try:
-        enhanced_image_bytes = enhance_image_for_ocr(image_bytes)
-        base64_image = base64.b64encode(enhanced_image_bytes).decode('utf-8')
-        
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": "gpt-4-vision-preview",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": ENGLISH_PARSING_PROMPT},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-                    ]
-                }
-            ],
-            "max_tokens": 1500,
-            "temperature": 0.1
-        }
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=30
-            ) as response:
-                
-                response_text = await response.text()
-                logger.info(f"OpenAI response status: {response.status}")
-                
-                if response.status == 200:
-                    result = await response.json()
-                    content = result["choices"][0]["message"]["content"]
-                    
-                    json_match = re.search(r'\{.*\}', content, re.DOTALL)
-                    if json_match:
-                        data = json.loads(json_match.group())
-                        data["source"] = "openai_vision"
-                        logger.info("✅ OpenAI parsing successful")
-                        return data
-                    else:
-                        logger.error(f"❌ No JSON found in OpenAI response: {content[:200]}...")
-                else:
-                    logger.error(f"❌ OpenAI API error {response.status}: {response_text}")
-                        
-        return None
-        
-    except Exception as e:
-        logger.error(f"❌ OpenAI parsing error: {e}")
-        return None
+        data = orjson.loads(content)
+        if isinstance(data, dict):
+            return data
+    except orjson.JSONDecodeError:
+        pass
+    
+    json_text = find_json_object(content)
+    if json_text:
+        return orjson.loads(json_text)
+    return None
 
-async def parse_with_deepseek(image_bytes: bytes) -> Dict[str, Any]:
-    """Парсинг скриншота через DeepSeek с английским промтом"""
-    if not DEEPSEEK_API_KEY:
-        return None
-        
+async def call_vision(name: str, endpoint: str, headers: Dict[str, str], payload_template: Dict[str, Any],
+                      image_url: str, timeout: aiohttp.ClientTimeout,
+                      limiter=_NO_LIMIT) -> Optional[Dict[str, Any]]:
+    """Общий запрос к vision-модели: промт + скриншот, ответ разбирается в JSON"""
     try:
-        enhanced_image_bytes = enhance_image_for_ocr(image_bytes)
-        base64_image = base64.b64encode(enhanced_image_bytes).decode('utf-8')
-        
-        headers = {
-            "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
         payload = {
-            "model": "deepseek-chat",
+            **payload_template,
             "messages": [
                 {
                     "role": "user",
                     "content": [
                         {"type": "text", "text": ENGLISH_PARSING_PROMPT},
-                        {"type": "image_url", "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }}
+                        {"type": "image_url", "image_url": {"url": image_url}}
                     ]
                 }
-            ],
-            "temperature": 0.1,
-            "max_tokens": 1500
+            ]
         }
         
-        logger.info("🔄 DeepSeek API request...")
+        body = orjson.dumps(payload)
+        session = app.state.http
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.deepseek.com/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=30
-            ) as response:
-                
-                response_text = await response.text()
-                logger.info(f"DeepSeek response status: {response.status}")
+        async with asyncio.timeout(VISION_DEADLINE):
+            # Последняя попытка идёт без паузы после неё: None вместо задержки
+            for delay in chain(VISION_RETRY_DELAYS, (None,)):
+                logger.info(f"🔄 {name} API request...")
+                try:
+                    async with limiter, session.post(
+                        endpoint,
+                        headers=headers,
+                        data=body,
+                        timeout=timeout
+                    ) as response:
+                        status = response.status
+                        raw_body = await response.read()
+                except _RETRY_ERRORS as e:
+                    if delay is None:
+                        raise
+                    logger.warning(f"⚠️ {name} connection failed ({e!r}), retry in {delay}s")
+                    await asyncio.sleep(delay)
+                    continue
                 
-                if response.status == 200:
-                    result = await response.json()
-                    content = result["choices"][0]["message"]["content"]
+                logger.info(f"{name} response status: {status}")
+                if status in _RETRY_STATUSES and delay is not None:
+                    logger.warning(f"⚠️ {name} answered {status}, retry in {delay}s")
+                    await asyncio.sleep(delay)
+                    continue
+                break
+        
+        if status == 200:
+            result = orjson.loads(raw_body)
+            content = result["choices"][0]["message"]["content"]
+            
+            data = extract_json_from_content(content)
+            if data:
+                data["source"] = f"{name.lower()}_vision"
+                logger.info(f"✅ {name} parsing successful")
+                return data
+            else:
+                logger.error(f"❌ No JSON found in {name} response: {content[:200]}...")
+        else:
+            logger.error(f"❌ {name} API error {status}: {raw_body.decode(errors='replace')}")
                     
-                    json_match = re.search(r'\{.*\}', content, re.DOTALL)
-                    if json_match:
-                        data = json.loads(json_match.group())
-                        data["source"] = "deepseek_vision"
-                        logger.info("✅ DeepSeek parsing successful")
-                        return data
-                    else:
-                        logger.error(f"❌ No JSON found in DeepSeek response: {content[:200]}...")
-                else:
-                    logger.error(f"❌ DeepSeek API error {response.status}: {response_text}")
-                        
         return None
         
+    except TimeoutError:
+        logger.error(f"⏱️ {name} timed out")
+        return None
     except Exception as e:
-        logger.error(f"❌ DeepSeek parsing error: {e}")
+        logger.error(f"❌ {name} parsing error: {e}")
         return None
 
+async def parse_with_openai(image_url: str) -> Dict[str, Any]:
+    """Парсинг улучшенного скриншота через OpenAI с английским промтом"""
+    if not OPENAI_API_KEY:
+        return None
+    return await call_vision(
+        "OpenAI", "https://api.openai.com/v1/chat/completions",
+        _OPENAI_HEADERS, _OPENAI_PAYLOAD_TEMPLATE, image_url, timeout=_VISION_TIMEOUT
+    )
+
+async def parse_with_deepseek(image_url: str) -> Dict[str, Any]:
+    """Парсинг улучшенного скриншота через DeepSeek с английским промтом"""
+    if not DEEPSEEK_API_KEY:
+        return None
+    return await call_vision(
+        "DeepSeek", "https://api.deepseek.com/chat/completions",
+        _DEEPSEEK_HEADERS, _DEEPSEEK_PAYLOAD_TEMPLATE, image_url,
+        timeout=_VISION_TIMEOUT, limiter=_DEEPSEEK_SEM
+    )
+
+def has_tides(data: Dict) -> bool:
+    """Есть ли в данных и приливы, и отливы (Windy API их никогда не отдаёт)"""
+    tides = data.get('tides')
+    return bool(tides and tides.get('high_times') and tides.get('low_times'))
+
 def calculate_data_quality_score(data: Dict) -> int:
     """Оценка качества данных (0-100 баллов)"""
     score = 0
@@ -328,10 +470,8 @@ def calculate_data_quality_score(data: Dict) -> int:
         if data.get(key) and len(data[key]) >= 6:
             score += 20
     
-    if data.get('tides'):
-        tides = data['tides']
-        if tides.get('high_times') and tides.get('low_times'):
-            score += 20
+    if has_tides(data):
+        score += 20
     
     if data.get('wave_data'):
         max_wave = max(data['wave_data'])
@@ -345,8 +485,10 @@ def calculate_data_quality_score(data: Dict) -> int:
     
     return score
 
-def merge_triple_ai_data(openai_data: Dict, deepseek_data: Dict, windy_data: Dict) -> Dict[str, Any]:
-    """УМНОЕ СЛИЯНИЕ ДАННЫХ ОТ ТРЕХ ИСТОЧНИКОВ"""
+def merge_triple_ai_data(openai_data: Dict, deepseek_data: Dict, windy_data: Dict,
+                         scores: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """УМНОЕ СЛИЯНИЕ ДАННЫХ ОТ ТРЕХ ИСТОЧНИКОВ (scores - уже посчитанные оценки по имени источника)"""
+    scores = scores or {}
     sources = [
         (openai_data, "OpenAI"),
         (deepseek_data, "DeepSeek"), 
@@ -356,7 +498,9 @@ def merge_triple_ai_data(openai_data: Dict, deepseek_data: Dict, windy_data: Dic
     scored_sources = []
     for data, name in sources:
         if data:
-            score = calculate_data_quality_score(data)
+            score = scores.get(name)
+            if score is None:
+                score = calculate_data_quality_score(data)
             scored_sources.append((data, name, score))
             logger.info(f"📊 {name} quality score: {score}")
     
@@ -386,239 +530,262 @@ def merge_triple_ai_data(openai_data: Dict, deepseek_data: Dict, windy_data: Dic
     
     return merged
 
-def calculate_ranges(data_list):
-    """Рассчитывает диапазон значений"""
-    if not data_list:
+def calculate_ranges(stats):
+    """Рассчитывает диапазон значений по готовой статистике ряда"""
+    if not stats:
         return "N/A"
-    min_val = min(data_list)
-    max_val = max(data_list)
+    _, min_val, max_val, _ = stats
     return f"{min_val:.1f}-{max_val:.1f}"
 
-def generate_wave_comment(wave_data):
+# 💬 ШАБЛОНЫ КОММЕНТАРИЕВ (форматируется только выбранный)
+_WAVE_TINY = (
+    "🤏 {v:.1f}м? Это не волны, это ЗЕВОТ океана! Даже утки не испугаются!",
+    "💤 {v:.1f}м? Серьёзно? Лучше поспи подольше!",
+    "🛌 {v:.1f}м волна? Идеально для сна на пляже!",
+)
+
+_WAVE_SMALL = (
+    "🫤 {v:.1f}м? Для начинающих богов сойдёт... наверное...",
+    "👶 {v:.1f}м - идеально для первого раза! Если не боишься промочить ноги!",
+    "🔄 {v:.1f}м? Хватит, чтобы вспомнить, как держать доску!",
+)
+
+_WAVE_MEDIUM = (
+    "👍 {v:.1f}м? Уже теплее! Можно поймать пару линий!",
+    "💪 {v:.1f}м - достойно для смертного! Риф просыпается!",
+    "🌊 {v:.1f}м? Не боги горшки обжигают... но попробуй!",
+)
+
+_WAVE_BIG = (
+    "🔥 {v:.1f}м? ОКЕАН ПРОСНУЛСЯ! Готовь большую доску!",
+    "🤯 {v:.1f}м? ВОТ ЭТО ДА! Риф работает на полную!",
+    "💥 {v:.1f}м? БОЖЕСТВЕННО! Даже я, Посейдон, впечатлён!",
+)
+
+_PERIOD_SHORT = (
+    "😫 {v:.1f}с? Волны как икота - частые и бесполезные!",
+    "🌀 {v:.1f}с? Слишком часто! Даже доска не успеет отдышаться!",
+    "🤢 {v:.1f}с? Морская болезнь гарантирована!",
+)
+
+_PERIOD_NORMAL = (
+    "😐 {v:.1f}с? Нормально, но ничего выдающегося!",
+    "🔄 {v:.1f}с? Стандартный балуанский период!",
+    "💫 {v:.1f}с? Волны ровные, можно кататься!",
+)
+
+_PERIOD_LONG = (
+    "🔥 {v:.1f}с? МОЩНО! Волны упругие и мощные!",
+    "💪 {v:.1f}с? ОТЛИЧНО! Хватит энергии для длинных линий!",
+    "🚀 {v:.1f}с? БОЖЕСТВЕННЫЙ период! Наслаждайся!",
+)
+
+_POWER_LOW = (
+    "🪫 {v}кДж? Энергии хватит разве что на гребешок!",
+    "😴 {v}кДж? Это не мощность, это ШЁПОТ океана!",
+    "🫣 {v}кДж? Даже медуза пронесётся мимо!",
+)
+
+_POWER_MEDIUM = (
+    "🫤 {v}кДж? Ну, для разминки сойдёт...",
+    "💫 {v}кДж? Скромно, но катабельно!",
+    "🔄 {v}кДж? Стандартная мощность для тренировки!",
+)
+
+_POWER_HIGH = (
+    "💥 {v}кДж? ТУРБО-ЗАРЯД! Океан не шутит!",
+    "🚀 {v}кДж? МОЩНОСТЬ ЗАШКАЛИВАЕТ! Готовься!",
+    "🌪️ {v}кДж? ЭНЕРГИИ ХВАТИТ НА ВСЕХ!",
+)
+
+_WIND_CALM = (
+    "🌬️ {v}м/с? Идеальный оффшор! Волна будет чистой!",
+    "😌 {v}м/с? Ветер как шёлк! Идеальные условия!",
+    "🌟 {v}м/с? Боги ветра благоволят тебе!",
+)
+
+_WIND_MODERATE = (
+    "💨 {v}м/с? Нормальный ветер, можно кататься!",
+    "🔄 {v}м/с? Стандартные условия!",
+    "🌊 {v}м/с? Ветер есть, но не испортит всё!",
+)
+
+_WIND_STRONG = (
+    "🌪️ {v}м/с? ВЕТРЕНЫЙ АПОКАЛИПСИС! Волны в кашу!",
+    "😫 {v}м/с? Сильный ветер испортит все волны!",
+    "💥 {v}м/с? ВЕТРЯНАЯ МЕЛЬНИЦА! Лучше остаться дома!",
+)
+
+# 🪜 ГРАНИЦЫ КОРЗИН: (пороги, шаблоны); значение ниже порога попадает в его корзину
+_WAVE_BUCKETS = ((1.0, 1.5, 1.8), (_WAVE_TINY, _WAVE_SMALL, _WAVE_MEDIUM, _WAVE_BIG))
+_PERIOD_BUCKETS = ((8, 12), (_PERIOD_SHORT, _PERIOD_NORMAL, _PERIOD_LONG))
+_POWER_BUCKETS = ((300, 600), (_POWER_LOW, _POWER_MEDIUM, _POWER_HIGH))
+_WIND_BUCKETS = ((2.0, 4.0), (_WIND_CALM, _WIND_MODERATE, _WIND_STRONG))
+
+def pick_template(value, buckets) -> str:
+    """Случайный шаблон из корзины, в которую попадает значение"""
+    thresholds, pools = buckets
+    return random.choice(pools[bisect_right(thresholds, value)])
+
+# Тренд ряда: падает / стоит / растёт
+_TRENDS = ("📉", "➡️", "📈")
+
+def calculate_stats(data_list) -> Optional[Tuple[float, float, float, str]]:
+    """Среднее, минимум, максимум и тренд ряда за один проход"""
+    if not data_list:
+        return None
+    
+    total = 0.0
+    min_val = max_val = data_list[0]
+    for value in data_list:
+        total += value
+        if value < min_val:
+            min_val = value
+        elif value > max_val:
+            max_val = value
+    
+    first, last = data_list[0], data_list[-1]
+    trend = _TRENDS[(last > first) - (last < first) + 1]
+    return total / len(data_list), min_val, max_val, trend
+
+def generate_wave_comment(wave_stats):
     """УМНАЯ генерация комментария о волне"""
-    if not wave_data:
+    if not wave_stats:
         return "📉 Данные о волне отсутствуют. Видимо, Посейдон сегодня молчит."
     
-    avg_wave = sum(wave_data) / len(wave_data)
-    max_wave = max(wave_data)
-    
-    if avg_wave < 1.0:
-        comments = [
-            f"🤏 {avg_wave:.1f}м? Это не волны, это ЗЕВОТ океана! Даже утки не испугаются!",
-            f"💤 {avg_wave:.1f}м? Серьёзно? Лучше поспи подольше!",
-            f"🛌 {avg_wave:.1f}м волна? Идеально для сна на пляже!",
-        ]
-    elif avg_wave < 1.5:
-        comments = [
-            f"🫤 {avg_wave:.1f}м? Для начинающих богов сойдёт... наверное...",
-            f"👶 {avg_wave:.1f}м - идеально для первого раза! Если не боишься промочить ноги!",
-            f"🔄 {avg_wave:.1f}м? Хватит, чтобы вспомнить, как держать доску!",
-        ]
-    elif avg_wave < 1.8:
-        comments = [
-            f"👍 {avg_wave:.1f}м? Уже теплее! Можно поймать пару линий!",
-            f"💪 {avg_wave:.1f}м - достойно для смертного! Риф просыпается!",
-            f"🌊 {avg_wave:.1f}м? Не боги горшки обжигают... но попробуй!",
-        ]
-    else:
-        comments = [
-            f"🔥 {avg_wave:.1f}м? ОКЕАН ПРОСНУЛСЯ! Готовь большую доску!",
-            f"🤯 {avg_wave:.1f}м? ВОТ ЭТО ДА! Риф работает на полную!",
-            f"💥 {avg_wave:.1f}м? БОЖЕСТВЕННО! Даже я, Посейдон, впечатлён!",
-        ]
-    
-    trend = "📈" if wave_data[0] < wave_data[-1] else "📉" if wave_data[0] > wave_data[-1] else "➡️"
-    return f"{trend} {random.choice(comments)}"
+    avg_wave, _, _, trend = wave_stats
+    return f"{trend} {pick_template(avg_wave, _WAVE_BUCKETS).format(v=avg_wave)}"
 
-def generate_period_comment(period_data):
+def generate_period_comment(period_stats):
     """УМНАЯ генерация комментария о периоде"""
-    if not period_data:
+    if not period_stats:
         return "📉 Период? Какой период? Здесь только хаос!"
     
-    avg_period = sum(period_data) / len(period_data)
-    
-    if avg_period < 8:
-        comments = [
-            f"😫 {avg_period:.1f}с? Волны как икота - частые и бесполезные!",
-            f"🌀 {avg_period:.1f}с? Слишком часто! Даже доска не успеет отдышаться!",
-            f"🤢 {avg_period:.1f}с? Морская болезнь гарантирована!",
-        ]
-    elif avg_period < 12:
-        comments = [
-            f"😐 {avg_period:.1f}с? Нормально, но ничего выдающегося!",
-            f"🔄 {avg_period:.1f}с? Стандартный балуанский период!",
-            f"💫 {avg_period:.1f}с? Волны ровные, можно кататься!",
-        ]
-    else:
-        comments = [
-            f"🔥 {avg_period:.1f}с? МОЩНО! Волны упругие и мощные!",
-            f"💪 {avg_period:.1f}с? ОТЛИЧНО! Хватит энергии для длинных линий!",
-            f"🚀 {avg_period:.1f}с? БОЖЕСТВЕННЫЙ период! Наслаждайся!",
-        ]
-    
-    trend = "📈" if period_data[0] < period_data[-1] else "📉" if period_data[0] > period_data[-1] else "➡️"
-    return f"{trend} {random.choice(comments)}"
+    avg_period, _, _, trend = period_stats
+    return f"{trend} {pick_template(avg_period, _PERIOD_BUCKETS).format(v=avg_period)}"
 
-def generate_power_comment(power_data):
+def generate_power_comment(power_stats):
     """УМНАЯ генерация комментария о мощности"""
-    if not power_data:
+    if not power_stats:
         return "📉 Мощность? Какая мощность? Здесь только слабость!"
     
-    avg_power = sum(power_data) / len(power_data)
-    
-    if avg_power < 300:
-        comments = [
-            f"🪫 {int(avg_power)}кДж? Энергии хватит разве что на гребешок!",
-            f"😴 {int(avg_power)}кДж? Это не мощность, это ШЁПОТ океана!",
-            f"🫣 {int(avg_power)}кДж? Даже медуза пронесётся мимо!",
-        ]
-    elif avg_power < 600:
-        comments = [
-            f"🫤 {int(avg_power)}кДж? Ну, для разминки сойдёт...",
-            f"💫 {int(avg_power)}кДж? Скромно, но катабельно!",
-            f"🔄 {int(avg_power)}кДж? Стандартная мощность для тренировки!",
-        ]
-    else:
-        comments = [
-            f"💥 {int(avg_power)}кДж? ТУРБО-ЗАРЯД! Океан не шутит!",
-            f"🚀 {int(avg_power)}кДж? МОЩНОСТЬ ЗАШКАЛИВАЕТ! Готовься!",
-            f"🌪️ {int(avg_power)}кДж? ЭНЕРГИИ ХВАТИТ НА ВСЕХ!",
-        ]
-    
-    trend = "📈" if power_data[0] < power_data[-1] else "📉" if power_data[0] > power_data[-1] else "➡️"
-    return f"{trend} {random.choice(comments)}"
+    avg_power, _, _, trend = power_stats
+    return f"{trend} {pick_template(avg_power, _POWER_BUCKETS).format(v=int(avg_power))}"
 
-def generate_wind_comment(wind_data):
+def generate_wind_comment(wind_stats):
     """УМНАЯ генерация комментария о ветре"""
-    if not wind_data:
+    if not wind_stats:
         return "💨 Ветер? Тут даже бриза нет для твоих жалких надежд."
     
-    max_wind = max(wind_data)
-    
-    if max_wind < 2.0:
-        comments = [
-            f"🌬️ {max_wind}м/с? Идеальный оффшор! Волна будет чистой!",
-            f"😌 {max_wind}м/с? Ветер как шёлк! Идеальные условия!",
-            f"🌟 {max_wind}м/с? Боги ветра благоволят тебе!",
-        ]
-    elif max_wind < 4.0:
-        comments = [
-            f"💨 {max_wind}м/с? Нормальный ветер, можно кататься!",
-            f"🔄 {max_wind}м/с? Стандартные условия!",
-            f"🌊 {max_wind}м/с? Ветер есть, но не испортит всё!",
-        ]
-    else:
-        comments = [
-            f"🌪️ {max_wind}м/с? ВЕТРЕНЫЙ АПОКАЛИПСИС! Волны в кашу!",
-            f"😫 {max_wind}м/с? Сильный ветер испортит все волны!",
-            f"💥 {max_wind}м/с? ВЕТРЯНАЯ МЕЛЬНИЦА! Лучше остаться дома!",
-        ]
-    
-    return f"💨 {random.choice(comments)}"
+    _, _, max_wind, _ = wind_stats
+    return f"💨 {pick_template(max_wind, _WIND_BUCKETS).format(v=max_wind)}"
+
+# 🗣️ ШАБЛОНЫ ВСТУПЛЕНИЯ И ВЕРДИКТА (форматируется только выбранный)
+_INTRO_TEMPLATES = (
+    "Серьёзно? Опять это место?",
+    "Очередной день, очередные иллюзии...",
+    "Надеюсь, волны интереснее твоего выбора спота!",
+    "Снова ты... и снова {location}... скучно.",
+    "Мои оракулы зевают от предсказуемости!"
+)
 
 def generate_sarcastic_intro(location):
     """Генерирует саркастичное вступление"""
-    comments = [
-        "Серьёзно? Опять это место?",
-        "Очередной день, очередные иллюзии...",
-        "Надеюсь, волны интереснее твоего выбора спота!",
-        "Снова ты... и снова {location}... скучно.",
-        "Мои оракулы зевают от предсказуемости!"
-    ]
-    return random.choice(comments).format(location=location)
+    return random.choice(_INTRO_TEMPLATES).format(location=location)
 
-def generate_sarcastic_verdict(wave_data, period_data, wind_data):
+_VERDICT_WAVE_SMALL = (
+    "Мелко, но бодро. Идеально для тренировки... падений.",
+    "Волны как твои амбиции - почти незаметны.",
+    "Подходит для серфинга... если ты морская свинка."
+)
+_VERDICT_WAVE_MEDIUM = (
+    "Неплохо для начинающего. Если не считать, что ты 'уже 3 года начинающий'.",
+    "Волны есть, навыков - предсказуемо нет.",
+    "Достойно! Если ты не я, конечно."
+)
+_VERDICT_WAVE_BIG = (
+    "Океан проснулся! Надеюсь, ты тоже.",
+    "Серьёзные волны для несерьёзного серфера.",
+    "Мощно! Жаль, что не про тебя."
+)
+_VERDICT_PERIOD_LONG = ("Длинный период — как твои обещания 'встать пораньше'.",)
+_VERDICT_PERIOD_SHORT = ("Короткий период — как твое терпение.",)
+_VERDICT_WIND_STRONG = ("Ветер норм, но не поможет, если у тебя руки как у краба.",)
+
+def generate_sarcastic_verdict(wave_stats, period_stats, wind_stats):
     """Генерирует саркастичный вердикт"""
-    if not all([wave_data, period_data, wind_data]):
+    if not all([wave_stats, period_stats, wind_stats]):
         return "Данные как твои планы - неполные и запутанные."
     
-    avg_wave = sum(wave_data) / len(wave_data)
-    avg_period = sum(period_data) / len(period_data)
-    max_wind = max(wind_data)
-    
-    verdicts = []
+    avg_wave = wave_stats[0]
+    avg_period = period_stats[0]
+    max_wind = wind_stats[2]
     
     if avg_wave < 1.0:
-        verdicts.extend([
-            "Мелко, но бодро. Идеально для тренировки... падений.",
-            "Волны как твои амбиции - почти незаметны.",
-            "Подходит для серфинга... если ты морская свинка."
-        ])
+        verdicts = _VERDICT_WAVE_SMALL
     elif avg_wave < 1.5:
-        verdicts.extend([
-            "Неплохо для начинающего. Если не считать, что ты 'уже 3 года начинающий'.",
-            "Волны есть, навыков - предсказуемо нет.",
-            "Достойно! Если ты не я, конечно."
-        ])
+        verdicts = _VERDICT_WAVE_MEDIUM
     else:
-        verdicts.extend([
-            "Океан проснулся! Надеюсь, ты тоже.",
-            "Серьёзные волны для несерьёзного серфера.",
-            "Мощно! Жаль, что не про тебя."
-        ])
+        verdicts = _VERDICT_WAVE_BIG
     
     if avg_period > 12:
-        verdicts.append("Длинный период — как твои обещания 'встать пораньше'.")
+        verdicts += _VERDICT_PERIOD_LONG
     elif avg_period < 8:
-        verdicts.append("Короткий период — как твое терпение.")
+        verdicts += _VERDICT_PERIOD_SHORT
     
     if max_wind > 4.0:
-        verdicts.append("Ветер норм, но не поможет, если у тебя руки как у краба.")
+        verdicts += _VERDICT_WIND_STRONG
     
     return random.choice(verdicts)
 
+# ⏰ ВРЕМЕННЫЕ СЛОТЫ ТАБЛИЦЫ WINDY
+_TIME_SLOTS = ("02:00", "05:00", "08:00", "11:00", "14:00", "17:00", "20:00", "23:00")
+
+_BEST_TIME_TEMPLATES = (
+    "Твой наименее ужасный шанс - около {time}. Но не обольщайся!",
+    "Попробуй в {time}. Может быть, океан смилостивится над тобой.",
+    "{time} - твой час славы... или очередного разочарования.",
+)
+
 def get_best_time_recommendation(wind_data, power_data):
     """Рекомендует лучшее время для серфинга"""
     if not wind_data or not power_data:
         return "🎯 Вставай на рассвете, лови прилив. Или не вставай - какая разница?"
     
-    best_time_index = 0
-    best_score = -999
-    
-    for i in range(min(6, len(wind_data))):
-        wind_score = -wind_data[i] * 2
-        power_score = power_data[i] / 200
-        
-        total_score = wind_score + power_score
-        
-        if total_score > best_score:
-            best_score = total_score
-            best_time_index = i
+    # Оценка слота: слабый ветер и мощная волна; при равенстве побеждает более ранний
+    scores = [power / 200 - wind * 2 for wind, power in zip(wind_data[:6], power_data)]
+    best_time_index = max(range(len(scores)), key=scores.__getitem__)
     
-    time_slots = ["02:00", "05:00", "08:00", "11:00", "14:00", "17:00", "20:00", "23:00"]
-    
-    if best_time_index < len(time_slots):
-        best_time = time_slots[best_time_index]
-        recommendations = [
-            f"Твой наименее ужасный шанс - около {best_time}. Но не обольщайся!",
-            f"Попробуй в {best_time}. Может быть, океан смилостивится над тобой.",
-            f"{best_time} - твой час славы... или очередного разочарования.",
-        ]
-        return random.choice(recommendations)
+    if best_time_index < len(_TIME_SLOTS):
+        return random.choice(_BEST_TIME_TEMPLATES).format(time=_TIME_SLOTS[best_time_index])
     
     return "🎯 Вставай на рассвете, лови прилив. Или не вставай - какая разница?"
 
+def pair_tides(times, heights):
+    """Пары (время, высота) за один проход; недостающие высоты заменяются на '?'"""
+    return zip(times, chain(heights, repeat("?")))
+
 def format_tides_for_prompt(tides_data):
     """Форматирует приливы для промта"""
     if not tides_data:
-        return "Нет данных о приливах"
-    
-    high_times = tides_data.get('high_times', [])
-    high_heights = tides_data.get('high_heights', [])
-    low_times = tides_data.get('low_times', [])
-    low_heights = tides_data.get('low_heights', [])
+        return "Нет данных о приливах", "Нет данных о приливах"
     
-    high_tides = []
-    for i, time in enumerate(high_times):
-        height = high_heights[i] if i < len(high_heights) else "?"
-        high_tides.append(f"{time} ({height} м)")
-    
-    low_tides = []
-    for i, time in enumerate(low_times):
-        height = low_heights[i] if i < len(low_heights) else "?"
-        low_tides.append(f"{time} ({height} м)")
+    high_tides = ", ".join(
+        f"{time} ({height} м)"
+        for time, height in pair_tides(tides_data.get('high_times', []), tides_data.get('high_heights', []))
+    )
+    low_tides = ", ".join(
+        f"{time} ({height} м)"
+        for time, height in pair_tides(tides_data.get('low_times', []), tides_data.get('low_heights', []))
+    )
     
-    return ", ".join(high_tides), ", ".join(low_tides)
+    return high_tides, low_tides
+
+_TIDE_TEMPLATES = (
+    "{tides}. Утренний прилив в {first_high} - твой шанс!",
+    "Океан дышит: {tides}. Планируй атаку на {attack}!",
+    "График приливов: {tides}. {first_high} - звёздный час!",
+)
 
 def analyze_tides_correctly(tides_data):
     """Правильный анализ приливов/отливов"""
@@ -630,68 +797,61 @@ def analyze_tides_correctly(tides_data):
     high_heights = tides_data.get('high_heights', [])
     low_heights = tides_data.get('low_heights', [])
     
-    tides_info = []
-    
-    if high_times:
-        for i, time in enumerate(high_times):
-            height = high_heights[i] if i < len(high_heights) else "?"
-            tides_info.append(f"🌊 {time}({height}м)")
-    
-    if low_times:
-        for i, time in enumerate(low_times):
-            height = low_heights[i] if i < len(low_heights) else "?"
-            tides_info.append(f"🏖️ {time}({height}м)")
+    tides_info = [f"🌊 {time}({height}м)" for time, height in pair_tides(high_times, high_heights)]
+    tides_info += [f"🏖️ {time}({height}м)" for time, height in pair_tides(low_times, low_heights)]
     
     if not tides_info:
         return "🌅 Без приливов - как серфер без доски. Бессмысленно и грустно."
     
-    morning_tide = ""
-    for time in high_times:
-        if int(time.split(':')[0]) < 12:
-            morning_tide = time
-            break
-    
-    comments = [
-        f"{' '.join(tides_info)}. Утренний прилив в {morning_tide if morning_tide else high_times[0]} - твой шанс!",
-        f"Океан дышит: {' '.join(tides_info)}. Планируй атаку на {morning_tide if morning_tide else 'рассвет'}!",
-        f"График приливов: {' '.join(tides_info)}. {morning_tide if morning_tide else high_times[0]} - звёздный час!",
-    ]
+    # "HH:MM" с ведущим нулём сравнивается как строка так же, как по числу часов
+    morning_tide = next((time for time in high_times if time.zfill(5) < "12:"), "")
     
-    return random.choice(comments)
+    # Форматируем только выбранный шаблон
+    return random.choice(_TIDE_TEMPLATES).format(
+        tides=" ".join(tides_info),
+        first_high=morning_tide or (high_times[0] if high_times else "рассвет"),
+        attack=morning_tide or "рассвет"
+    )
 
-def generate_dynamic_fallback_data():
-    """Генерирует реалистичные случайные данные для любого спота"""
-    conditions = [
-        {
-            "wave": [1.3, 1.3, 1.4, 1.4, 1.4, 1.4, 1.4, 1.4, 1.5, 1.5],
-            "period": [14.6, 14.3, 13.9, 12.7, 12.0, 11.9, 11.7, 11.5, 11.3, 11.1],
-            "power": [736, 744, 730, 628, 570, 559, 555, 553, 555, 558],
-            "wind": [0.6, 1.3, 0.9, 1.3, 3.0, 3.8, 3.4, 1.9, 1.0, 0.6]
-        },
-        {
-            "wave": [1.7, 1.6, 1.6, 1.5, 1.5, 1.4, 1.4, 1.4, 1.3, 1.3],
-            "period": [10.2, 10.2, 10.0, 9.9, 9.7, 9.8, 9.2, 9.2, 9.0, 8.9],
-            "power": [586, 547, 501, 454, 412, 396, 331, 317, 291, 277],
-            "wind": [1.3, 1.6, 0.6, 2.4, 3.6, 3.9, 0.6, 0.5, 0.2, 0.8]
-        }
-    ]
-    
-    chosen = random.choice(conditions)
-    
-    return {
+# 🎲 ЗАПАСНЫЕ УСЛОВИЯ (собираются один раз, вызывающий код их только читает)
+_FALLBACK_TIDES = {
+    "high_times": ("10:20", "22:10"),
+    "high_heights": (2.5, 3.2),
+    "low_times": ("04:10", "16:00"),
+    "low_heights": (0.1, 0.7)
+}
+
+_FALLBACK_CONDITIONS = (
+    {
+        "wave": (1.3, 1.3, 1.4, 1.4, 1.4, 1.4, 1.4, 1.4, 1.5, 1.5),
+        "period": (14.6, 14.3, 13.9, 12.7, 12.0, 11.9, 11.7, 11.5, 11.3, 11.1),
+        "power": (736, 744, 730, 628, 570, 559, 555, 553, 555, 558),
+        "wind": (0.6, 1.3, 0.9, 1.3, 3.0, 3.8, 3.4, 1.9, 1.0, 0.6)
+    },
+    {
+        "wave": (1.7, 1.6, 1.6, 1.5, 1.5, 1.4, 1.4, 1.4, 1.3, 1.3),
+        "period": (10.2, 10.2, 10.0, 9.9, 9.7, 9.8, 9.2, 9.2, 9.0, 8.9),
+        "power": (586, 547, 501, 454, 412, 396, 331, 317, 291, 277),
+        "wind": (1.3, 1.6, 0.6, 2.4, 3.6, 3.9, 0.6, 0.5, 0.2, 0.8)
+    }
+)
+
+_FALLBACK_RESULTS = tuple(
+    {
         "success": True,
         "source": "dynamic_fallback",
-        "wave_data": chosen["wave"],
-        "period_data": chosen["period"],
-        "power_data": chosen["power"],
-        "wind_data": chosen["wind"],
-        "tides": {
-            "high_times": ["10:20", "22:10"],
-            "high_heights": [2.5, 3.2],
-            "low_times": ["04:10", "16:00"],
-            "low_heights": [0.1, 0.7]
-        }
+        "wave_data": conditions["wave"],
+        "period_data": conditions["period"],
+        "power_data": conditions["power"],
+        "wind_data": conditions["wind"],
+        "tides": _FALLBACK_TIDES
     }
+    for conditions in _FALLBACK_CONDITIONS
+)
+
+def generate_dynamic_fallback_data():
+    """Генерирует реалистичные случайные данные для любого спота"""
+    return dict(random.choice(_FALLBACK_RESULTS))
 
 def validate_surf_data(data: Dict) -> bool:
     """Проверяет валидность данных о серфинге"""
@@ -709,23 +869,58 @@ def validate_surf_data(data: Dict) -> bool:
         return False
     
     if data.get('wave_data'):
-        wave_ok = 0.1 < max(data['wave_data']) < 5.0
-        if not wave_ok:
-            logger.warning(f"❌ Wave data out of range: {max(data['wave_data'])}")
+        max_wave = max(data['wave_data'])
+        if not 0.1 < max_wave < 5.0:
+            logger.warning(f"❌ Wave data out of range: {max_wave}")
     
     if data.get('period_data'):
-        period_ok = 3.0 < max(data['period_data']) < 25.0
-        if not period_ok:
-            logger.warning(f"❌ Period data out of range: {max(data['period_data'])}")
+        max_period = max(data['period_data'])
+        if not 3.0 < max_period < 25.0:
+            logger.warning(f"❌ Period data out of range: {max_period}")
     
     if data.get('power_data'):
-        power_ok = max(data['power_data']) > 30
-        if not power_ok:
-            logger.warning(f"❌ Power data too low: {max(data['power_data'])}")
+        max_power = max(data['power_data'])
+        if not max_power > 30:
+            logger.warning(f"❌ Power data too low: {max_power}")
     
     return True
 
-async def build_poseidon_report(windy_data: Dict, location: str, date: str) -> str:
+# 📜 ШАБЛОН ЗАПАСНОГО ОТЧЕТА
+_REPORT_TEMPLATE = """🔱 ВНИМАНИЕ, СМЕРТНЫЙ! ПОСЕЙДОН ГОВОРИТ:
+
+Ты принёс мне прогноз на {location}? Смешно. Вот мой вердикт:
+
+📊 РАЗБОР ТВОИХ ЖАЛКИХ НАДЕЖД:
+
+🌊 ВОЛНА: {wave_range}м
+   {wave_comment}
+
+⏱️ ПЕРИОД: {period_range}сек
+   {period_comment}
+
+💪 МОЩНОСТЬ: {power_range}кДж
+   {power_comment}
+
+💨 ВЕТЕР: {wind_range}м/с
+   {wind_comment}
+
+🌅 ПРИЛИВЫ/ОТЛИВЫ:
+   {tides_comment}
+
+⚡ ВЕРДИКТ ПОСЕЙДОНА:
+   {overall_verdict}
+
+🎯 КОГДА ЖЕ ТЕБЕ МУЧИТЬ ВОЛНУ:
+   {best_time}
+
+💀 ЗАКЛЮЧЕНИЕ:
+   Прими мою волю и готовься к медитации на берегу.
+   Ваши планы - всего лишь песок у моих ног.
+
+🏄‍♂️ Колобрация POSEIDON V8.0 | TRIPLE-AI VERIFICATION
+Даже боги доверяют перекрестной проверке данных!"""
+
+def build_poseidon_report(windy_data: Dict, location: str, date: str) -> str:
     """ЗАПАСНАЯ функция сборки отчета (если AI не сработал)"""
     
     wave_data = windy_data.get('wave_data', [])
@@ -734,77 +929,62 @@ async def build_poseidon_report(windy_data: Dict, location: str, date: str) -> s
     wind_data = windy_data.get('wind_data', [])
     tides = windy_data.get('tides', {})
     
-    wave_comment = generate_wave_comment(wave_data)
-    period_comment = generate_period_comment(period_data)
-    power_comment = generate_power_comment(power_data)
-    wind_comment = generate_wind_comment(wind_data)
+    wave_stats = calculate_stats(wave_data)
+    period_stats = calculate_stats(period_data)
+    power_stats = calculate_stats(power_data)
+    wind_stats = calculate_stats(wind_data)
+    
+    wave_comment = generate_wave_comment(wave_stats)
+    period_comment = generate_period_comment(period_stats)
+    power_comment = generate_power_comment(power_stats)
+    wind_comment = generate_wind_comment(wind_stats)
     tides_comment = analyze_tides_correctly(tides)
-    overall_verdict = generate_sarcastic_verdict(wave_data, period_data, wind_data)
+    overall_verdict = generate_sarcastic_verdict(wave_stats, period_stats, wind_stats)
     best_time = get_best_time_recommendation(wind_data, power_data)
     
-    report_lines = [
-        "🔱 ВНИМАНИЕ, СМЕРТНЫЙ! ПОСЕЙДОН ГОВОРИТ:",
-        "",
-        f"Ты принёс мне прогноз на {location}? Смешно. Вот мой вердикт:",
-        "",
-        "📊 РАЗБОР ТВОИХ ЖАЛКИХ НАДЕЖД:",
-        "",
-        f"🌊 ВОЛНА: {calculate_ranges(wave_data)}м",
-        f"   {wave_comment}",
-        "",
-        f"⏱️ ПЕРИОД: {calculate_ranges(period_data)}сек", 
-        f"   {period_comment}",
-        "",
-        f"💪 МОЩНОСТЬ: {calculate_ranges(power_data)}кДж",
-        f"   {power_comment}",
-        "",
-        f"💨 ВЕТЕР: {calculate_ranges(wind_data)}м/с",
-        f"   {wind_comment}",
-        "",
-        "🌅 ПРИЛИВЫ/ОТЛИВЫ:",
-        f"   {tides_comment}",
-        "",
-        "⚡ ВЕРДИКТ ПОСЕЙДОНА:",
-        f"   {overall_verdict}",
-        "",
-        "🎯 КОГДА ЖЕ ТЕБЕ МУЧИТЬ ВОЛНУ:",
-        f"   {best_time}",
-        "",
-        "💀 ЗАКЛЮЧЕНИЕ:",
-        "   Прими мою волю и готовься к медитации на берегу.",
-        "   Ваши планы - всего лишь песок у моих ног.",
-        "",
-        "🏄‍♂️ Колобрация POSEIDON V8.0 | TRIPLE-AI VERIFICATION",
-        "Даже боги доверяют перекрестной проверке данных!"
-    ]
-    
-    return "\n".join(report_lines)
+    return _REPORT_TEMPLATE.format_map({
+        "location": location,
+        "wave_range": calculate_ranges(wave_stats),
+        "wave_comment": wave_comment,
+        "period_range": calculate_ranges(period_stats),
+        "period_comment": period_comment,
+        "power_range": calculate_ranges(power_stats),
+        "power_comment": power_comment,
+        "wind_range": calculate_ranges(wind_stats),
+        "wind_comment": wind_comment,
+        "tides_comment": tides_comment,
+        "overall_verdict": overall_verdict,
+        "best_time": best_time,
+    })
 
 async def generate_poseidon_response(final_data: Dict, location: str, date: str) -> str:
     """Генерация финального ответа на русском с данными от AI"""
     
-    spot_name = BALI_SPOTS.get(location.lower(), {}).get('name', location)
-    wave_range = calculate_ranges(final_data.get('wave_data', []))
-    period_range = calculate_ranges(final_data.get('period_data', []))
-    power_range = calculate_ranges(final_data.get('power_data', []))
-    wind_range = calculate_ranges(final_data.get('wind_data', []))
+    spot_name = (get_spot(location) or {}).get('name', location)
+    wave_data = final_data.get('wave_data', [])
+    period_data = final_data.get('period_data', [])
+    power_data = final_data.get('power_data', [])
+    wind_data = final_data.get('wind_data', [])
+    
+    wave_stats = calculate_stats(wave_data)
+    period_stats = calculate_stats(period_data)
+    power_stats = calculate_stats(power_data)
+    wind_stats = calculate_stats(wind_data)
+    
+    wave_range = calculate_ranges(wave_stats)
+    period_range = calculate_ranges(period_stats)
+    power_range = calculate_ranges(power_stats)
+    wind_range = calculate_ranges(wind_stats)
     
     high_tides, low_tides = format_tides_for_prompt(final_data.get('tides', {}))
     
     sarcastic_intro = generate_sarcastic_intro(spot_name)
-    wave_comment = generate_wave_comment(final_data.get('wave_data', []))
-    period_comment = generate_period_comment(final_data.get('period_data', []))
-    power_comment = generate_power_comment(final_data.get('power_data', []))
-    wind_comment = generate_wind_comment(final_data.get('wind_data', []))
-    overall_verdict = generate_sarcastic_verdict(
-        final_data.get('wave_data', []),
-        final_data.get('period_data', []), 
-        final_data.get('wind_data', [])
-    )
-    best_time = get_best_time_recommendation(
-        final_data.get('wind_data', []),
-        final_data.get('power_data', [])
-    )
+    wave_comment = generate_wave_comment(wave_stats)
+    period_comment = generate_period_comment(period_stats)
+    power_comment = generate_power_comment(power_stats)
+    wind_comment = generate_wind_comment(wind_stats)
+    overall_verdict = generate_sarcastic_verdict(wave_stats, period_stats, wind_stats)
+    best_time = get_best_time_recommendation(wind_data, power_data)
     
     response = f"""🔱 УСЛЫШАЛ ТВОЮ ПРОСЬБУ, БРО:
 
@@ -846,47 +1026,121 @@ async def generate_poseidon_response(final_data: Dict, location: str, date: str)
     
     return response
 
-async def analyze_windy_screenshot_triple_ai(image_bytes: bytes, spot_name: str, date: str) -> Dict[str, Any]:
+async def analyze_windy_screenshot_triple_ai(image_bytes: Union[bytes, bytearray, memoryview], spot_name: str, date: str) -> Dict[str, Any]:
     """ТРОЙНОЙ АНАЛИЗ: OpenAI + DeepSeek + Windy API"""
+    if not MIN_IMAGE_BYTES <= len(image_bytes) <= MAX_IMAGE_BYTES:
+        logger.info(f"⚠️ Image size {len(image_bytes)} bytes is not worth an AI call, using Windy API only")
+        windy_data = await fetch_windy_api_data(spot_name, date)
+        return merge_triple_ai_data(None, None, windy_data)
+    
+    digest = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    cache_key = (digest, spot_name, date)
+    cached = _ANALYSIS_CACHE.get(cache_key)
+    if cached is not None:
+        logger.info("♻️ Screenshot already analyzed, using cached result")
+        return cached
+    
     logger.info("🔄 Запуск ТРОЙНОГО AI анализа...")
-    start_time = time.time()
+    start_time = time.perf_counter()
     
-    openai_task = parse_with_openai(image_bytes)
-    deepseek_task = parse_with_deepseek(image_bytes) 
-    windy_task = fetch_windy_api_data(spot_name, date)
+    # Тот же скриншот с другой подписью: vision-модели его уже разбирали
+    openai_data = _VISION_CACHE.get(("openai", digest))
+    deepseek_data = _VISION_CACHE.get(("deepseek", digest))
     
-    openai_data, deepseek_data, windy_data = await asyncio.gather(
-        openai_task, deepseek_task, windy_task, return_exceptions=True
-    )
+    if openai_data is None or deepseek_data is None:
+        # Картинку улучшаем и кодируем один раз - её разбирают обе vision-модели.
+        # Pillow и base64 грузят CPU, поэтому работаем в потоке и не блокируем event loop
+        image_url = await asyncio.to_thread(prepare_image_payload, image_bytes)
     
-    if isinstance(openai_data, Exception):
-        logger.error(f"OpenAI parsing exception: {openai_data}")
-        openai_data = None
-    if isinstance(deepseek_data, Exception):
-        logger.error(f"DeepSeek parsing exception: {deepseek_data}")
-        deepseek_data = None
-    if isinstance(windy_data, Exception):
-        logger.error(f"Windy API exception: {windy_data}")
-        windy_data = None
+    # asyncio.sleep(0, result) - готовое значение в виде корутины для gather
+    openai_task = parse_with_openai(image_url) if openai_data is None else asyncio.sleep(0, openai_data)
+    deepseek_task = parse_with_deepseek(image_url) if deepseek_data is None else asyncio.sleep(0, deepseek_data)
+    windy_task = fetch_windy_api_data(spot_name, date)
     
-    final_data = merge_triple_ai_data(openai_data, deepseek_data, windy_data)
+    tasks = {
+        asyncio.create_task(openai_task): "OpenAI",
+        asyncio.create_task(deepseek_task): "DeepSeek",
+        asyncio.create_task(windy_task): "Windy API"
+    }
+    results = {}
+    scores = {}
+    
+    def collect(done) -> bool:
+        """Забирает готовые результаты; True, если среди них есть достаточно хороший разбор скриншота"""
+        good_enough = False
+        for task in done:
+            name = tasks[task]
+            if task.exception():
+                logger.error(f"{name} exception: {task.exception()}")
+                continue
+            results[name] = task.result()
+            if results[name]:
+                scores[name] = calculate_data_quality_score(results[name])
+                if name != "Windy API" and has_tides(results[name]) and scores[name] >= RACE_GOOD_SCORE:
+                    good_enough = True
+        return good_enough
+    
+    # Ждём не самый медленный источник, а первый достаточно хороший
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            if collect(done):
+                break
+        
+        if pending:
+            done, pending = await asyncio.wait(pending, timeout=RACE_GRACE_SECONDS)
+            collect(done)
+            for task in pending:
+                logger.info(f"⏱️ {tasks[task]} не успел, отменяем")
+    finally:
+        # Отменяем всех, кто ещё бежит: и после гонки, и если отменили сам анализ
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    
+    openai_data = results.get("OpenAI")
+    deepseek_data = results.get("DeepSeek")
+    windy_data = results.get("Windy API")
+    
+    for source, data in (("openai", openai_data), ("deepseek", deepseek_data)):
+        if data:
+            _VISION_CACHE[(source, digest)] = data
+    
+    final_data = merge_triple_ai_data(openai_data, deepseek_data, windy_data, scores)
     
-    total_time = time.time() - start_time
+    total_time = time.perf_counter() - start_time
     logger.info(f"✅ ТРОЙНОЙ анализ завершен за {total_time:.1f}с")
     
+    # Случайный fallback и разбор без приливов не кэшируем - при повторе стоит снова спросить AI
+    if final_data.get("source") != "dynamic_fallback" and has_tides(final_data):
+        _ANALYSIS_CACHE[cache_key] = final_data
+    
     return final_data
 
+# "спот дата" в подписи к скриншоту
+_CAPTION_RE = re.compile(r'^\s*(\S+)(?:\s+(\S+))?')
+
+# Сегодняшняя дата UTC и момент (unix time), когда она сменится
+_TODAY_CACHE = ["", 0.0]
+
+def today_str() -> str:
+    """Дата UTC в формате YYYY-MM-DD; пересчитывается раз в сутки, в полночь"""
+    now = time.time()
+    if now >= _TODAY_CACHE[1]:
+        day = int(now // 86400)
+        _TODAY_CACHE[0] = time.strftime('%Y-%m-%d', time.gmtime(day * 86400))
+        _TODAY_CACHE[1] = (day + 1) * 86400
+    return _TODAY_CACHE[0]
+
 def parse_caption_for_location_date(caption: Optional[str]):
     """Парсит подпись для извлечения локации и даты"""
-    if not caption:
-        return "uluwatu", str(datetime.utcnow().date())
-    
-    parts = caption.strip().split()
-    if not parts:
-        return "uluwatu", str(datetime.utcnow().date())
+    match = _CAPTION_RE.match(caption or "")
+    if not match:
+        return "uluwatu", today_str()
     
-    location = parts[0].lower()
-    date = parts[1] if len(parts) > 1 else str(datetime.utcnow().date())
+    location = match.group(1).lower()
+    date = match.group(2) or today_str()
     
     if location not in BALI_SPOTS:
         location = "uluwatu"
@@ -895,73 +1149,82 @@ def parse_caption_for_location_date(caption: Optional[str]):
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    state = USER_STATE.get(chat_id, {})
+    state = touch_state(chat_id)
     
-    if not state.get("active"):
+    if state is None or not state.active:
         await update.message.reply_text("🔱Посейдон в ярости! Разыгрываешь меня???!!!!")
         return
 
-    try:
-        await update.message.reply_text("🔱 УСЛЫШАЛ ТВОЮ ПРОСЬБУ, БРО! Сейчас поднимем для тебя, родной, со дна рукописи, 📜надеюсь не отсырели!")
-        
-        photo = update.message.photo[-1]
-        photo_file = await photo.get_file()
-        image_bytes = await photo_file.download_as_bytearray()
+    async with state.lock:
+        try:
+            await update.message.reply_text("🔱 УСЛЫШАЛ ТВОЮ ПРОСЬБУ, БРО! Сейчас поднимем для тебя, родной, со дна рукописи, 📜надеюсь не отсырели!")
+            
+            photo = update.message.photo[-1]
+            photo_file = await photo.get_file()
+            # Качаем прямо в буфер и дальше отдаём его memoryview без копий
+            download_buffer = BytesIO()
+            await photo_file.download_to_memory(out=download_buffer)
+            image_bytes = download_buffer.getbuffer()
 
-        caption = update.message.caption or ""
-        location, date = parse_caption_for_location_date(caption)
-        
-        if not location:
-            location = "uluwatu"
-        
-        windy_data = await analyze_windy_screenshot_triple_ai(bytes(image_bytes), location, date)
-        
-        report = await generate_poseidon_response(windy_data, location, date)
-        await update.message.reply_text(report)
-        
-        USER_STATE[chat_id] = {
-            "active": True, 
-            "awaiting_feedback": True,
-        }
-        await update.message.reply_text("Ну как тебе МЕГА-разбор, смертный? Отлично / не очень")
-        
-    except Exception as e:
-        logger.error(f"Error in handle_photo: {e}")
-        await update.message.reply_text("🔱 Посейдон в ярости! Что-то пошло не так. Попробуй ещё раз.")
+            caption = update.message.caption or ""
+            location, date = parse_caption_for_location_date(caption)
+            
+            if not location:
+                location = "uluwatu"
+            
+            windy_data = await analyze_windy_screenshot_triple_ai(image_bytes, location, date)
+            
+            report = await generate_poseidon_response(windy_data, location, date)
+            await update.message.reply_text(report)
+            
+            state.awaiting_feedback = True
+            await update.message.reply_text("Ну как тебе МЕГА-разбор, смертный? Отлично / не очень")
+            
+        except Exception as e:
+            logger.error(f"Error in handle_photo: {e}")
+            await update.message.reply_text("🔱 Посейдон в ярости! Что-то пошло не так. Попробуй ещё раз.")
+
+async def send_greeting(update: Update, chat_id: int):
+    """Активирует чат и отвечает на призыв Посейдона"""
+    state = touch_state(chat_id)
+    if state is None:
+        state = USER_STATE[chat_id] = ChatState()
+    state.active = True
+    state.awaiting_feedback = False
+    await update.message.reply_text(GREETING_TEXT)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений"""
     chat_id = update.effective_chat.id
-    text = (update.message.text or "").lower().strip()
-
-    if "посейдон на связь" in text.lower():
-        USER_STATE[chat_id] = {"active": True}
-        spot_list = "\n".join([f"• {spot['name']}" for spot in BALI_SPOTS.values()])
-        await update.message.reply_text(
-            f"🔱 Посейдон тут, смертный!\n\n"
-            f"Давай свой скриншот прогноза с подписью в формате:\n"
-            f"`balangan 2024-11-06`\n\n"
-            f"Доступные споты:\n{spot_list}\n\n"
-            f"Я проверю данные через 3 источника: OpenAI + DeepSeek + Windy API!"
-        )
+    state = touch_state(chat_id)
+    text = update.message.text or ""
+
+    if state is None or not (state.active or state.awaiting_feedback):
+        # Тихий чат: реагируем только на призыв, остальное не разбираем.
+        # Реплики короче призыва отсекаем до lower(), который копирует строку
+        if len(text) >= len(TRIGGER_PHRASE) and TRIGGER_PHRASE in text.lower():
+            await send_greeting(update, chat_id)
         return
 
-    state = USER_STATE.get(chat_id, {})
-    if state.get("awaiting_feedback"):
-        if "отлично" in text:
+    keywords = set(_KEYWORDS_RE.findall(text.lower()))
+
+    if TRIGGER_PHRASE in keywords:
+        await send_greeting(update, chat_id)
+        return
+
+    if state.awaiting_feedback:
+        if "отлично" in keywords:
             await update.message.reply_text("Ну так боги😇 Хорошей катки! Жду новый скриншот!")
-        elif "не очень" in text:
+        elif "не очень" in keywords:
             await update.message.reply_text("А не пора бы уже встать с дивана и катнуть? Жду новый скриншот!")
         else:
             await update.message.reply_text("Жду новый скриншот с прогнозом! 🏄‍♂️")
         
-        USER_STATE[chat_id] = {"active": True, "awaiting_feedback": False}
+        state.active = True
+        state.awaiting_feedback = False
         logger.info(f"Bot ready for new screenshot in chat {chat_id}")
         return
 
-    if not state.get("active"):
-        return
-
     await update.message.reply_text(
         "Отправь скриншот Windy с подписью в формате: `спот дата`\n"
         "Например: `uluwatu 2025-11-06`"
@@ -972,55 +1235,76 @@ bot_app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
 bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
 # FASTAPI ЭНДПОИНТЫ
+# Ответы служебных эндпоинтов не меняются: сериализуем их один раз при импорте
+_ROOT_JSON = orjson.dumps({
+    "status": "Poseidon V8 Online", 
+    "version": "8.0",
+    "features": "Triple-AI Analysis (OpenAI + DeepSeek + Windy API)",
+    "spots_available": len(BALI_SPOTS)
+})
+_PING_JSON = orjson.dumps({"status": "ok", "message": "Poseidon is awake and watching the waves!"})
+_SPOTS_JSON = orjson.dumps({
+    "spots": {name: data["name"] for name, data in BALI_SPOTS.items()},
+    "total": len(BALI_SPOTS)
+})
+
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
         update = TgUpdate.de_json(data, bot)
-        await bot_app.process_update(update)
-        return JSONResponse(content={"ok": True})
+        # Отвечаем Telegram сразу: разбор скриншота идёт десятки секунд, а на медленный ответ он шлёт повтор.
+        # Апдейт обработает сам bot_app из своей очереди, а bot_app.stop() дождётся начатого
+        await bot_app.update_queue.put(update)
+        return {"ok": True}
     except Exception as e:
         logger.error(f"Webhook error: {e}")
-        return JSONResponse(status_code=500, content={"ok": False})
+        return ORJSONResponse(status_code=500, content={"ok": False})
 
 @app.get("/")
 async def root():
-    return {
-        "status": "Poseidon V8 Online", 
-        "version": "8.0",
-        "features": "Triple-AI Analysis (OpenAI + DeepSeek + Windy API)",
-        "spots_available": len(BALI_SPOTS)
-    }
+    return Response(_ROOT_JSON, media_type="application/json")
 
 @app.get("/ping")
-@app.head("/ping")
 async def ping():
-    return {"status": "ok", "message": "Poseidon is awake and watching the waves!"}
+    return Response(_PING_JSON, media_type="application/json")
+
+@app.head("/ping")
+async def ping_head():
+    # Самопингу и мониторингам нужен только статус
+    return Response()
 
 @app.get("/spots")
 async def get_spots():
     """Возвращает список доступных спотов"""
-    return {
-        "spots": {name: data["name"] for name, data in BALI_SPOTS.items()},
-        "total": len(BALI_SPOTS)
-    }
+    return Response(_SPOTS_JSON, media_type="application/json")
 
 # ЗАПУСК ПРИЛОЖЕНИЯ
 @app.on_event("startup")
 async def startup():
+    # Один пул соединений на всё приложение: TCP+TLS переиспользуются между запросами
+    app.state.http = aiohttp.ClientSession(
+        # Общий потолок для запросов без своего таймаута; DeepSeek задаёт свой
+        timeout=aiohttp.ClientTimeout(total=30),
+        # Запросы раскиданы по трём хостам: общий потолок шире, но один хост не выжирает весь пул
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=32, ttl_dns_cache=300, keepalive_timeout=60)
+    )
     await bot_app.initialize()
     await bot_app.start()
-    asyncio.create_task(keep_alive_ping())
+    app.state.keepalive_task = asyncio.create_task(keep_alive_ping(app.state.http)) if ENABLE_KEEPALIVE else None
     logger.info("🏄‍♂️ Poseidon V8 awakened and ready for triple-AI analysis!")
     logger.info(f"📍 Available spots: {len(BALI_SPOTS)}")
 
 @app.on_event("shutdown")
 async def shutdown():
+    if app.state.keepalive_task:
+        app.state.keepalive_task.cancel()
     await bot_app.stop()
     await bot_app.shutdown()
+    await app.state.http.close()
     logger.info("🌊 Poseidon V8 returning to the depths...")
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 10000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="uvloop")
\ No newline at end of file